@@ -1,18 +1,110 @@
 """ Functions used for the pre-processing """
 
 import os
-from geopy.distance import vincenty
-from boltons.iterutils import pairwise
+import subprocess
 import geopandas as gpd
 import numpy as np
-from time import sleep
 import pandas as pd
+import pyogrio
+from joblib import Parallel, delayed, effective_n_jobs
+import shapely
 
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 
+try:
+    from numba import njit, prange
+    _HAS_NUMBA = True
+except ImportError:
+    # numba is optional: lines_length falls back to dense numpy array operations
+    def njit(*args, **kwargs):
+        return lambda func: func
+    prange = range
+    _HAS_NUMBA = False
+
+_EARTH_RADIUS_KM = 6371.0088
+# Buffers (in meters) below this size are created in degrees by Create_Buffer
+SMALL_BUFFER = 5000
+# Only features spanning less than this many degrees of latitude are buffered in degrees
+SMALL_BUFFER_LAT_SPAN = 0.5
+
+
+def precompute_sindex(df):
+    """ Build the spatial index used by spatial_overlays once, so that it is reused by all
+    subsequent overlays with the same df (e.g. the country boundary or the urban areas).
+    geopandas keeps the index with the geometries and drops it whenever they are modified.
+    Args:
+        *df* : GeoDataFrame
+    Returns:
+        The same GeoDataFrame, with its spatial index built
+    """
+    df.sindex
+    return df
 
-def spatial_overlays(df1, df2, how='intersection'):
+
+def _in_chunks(func, *arrays, n_jobs=-1):
+    """ Apply func to contiguous chunks of arrays in parallel threads and concatenate the results
+    Args:
+        *func* : Function returning a numpy array as long as its inputs, which releases the GIL (e.g. shapely operations)
+        *arrays* : Arrays or lists of the same length, sliced together
+        *n_jobs* : Number of threads, all cores by default (-1)
+    Returns:
+        A numpy array
+    """
+    n = len(arrays[0])
+    n_chunks = min(effective_n_jobs(n_jobs), n)
+    if n_chunks <= 1:
+        return func(*arrays)
+    bounds = np.linspace(0, n, n_chunks+1).astype(int)
+    results = Parallel(n_jobs=n_chunks, prefer='threads')(
+        delayed(func)(*(a[i:j] for a in arrays)) for i, j in zip(bounds[:-1], bounds[1:]))
+    return np.concatenate(results)
+
+
+def _erase(geoms1, groups, geoms2):
+    """ Union the geometries of geoms2 overlapping each geometry of geoms1 and erase them in one difference
+    Args:
+        *geoms1* : Array of shapely geometries
+        *groups* : List with, for each geometry of geoms1, the indices of the overlapping geometries of geoms2
+        *geoms2* : Array of shapely geometries
+    Returns:
+        An array of shapely geometries
+    """
+    hit = np.array([len(g) > 0 for g in groups], dtype=bool)
+    subtrahend = np.empty(len(geoms1), dtype=object)
+    subtrahend[hit] = [shapely.unary_union(geoms2[g]) for g in groups if len(g) > 0]
+    return shapely.difference(geoms1, subtrahend, out=geoms1.copy(), where=hit)
+
+
+def _make_valid(geoms):
+    """ Repair the invalid geometries of an array, valid ones are left untouched
+    Args:
+        *geoms* : Array of shapely geometries
+    Returns:
+        An array of valid shapely geometries, the input array is never modified
+    """
+    geoms = np.asarray(geoms)
+    invalid = ~shapely.is_valid(geoms)
+    if invalid.any():
+        geoms = geoms.copy()
+        geoms[invalid] = shapely.make_valid(geoms[invalid])
+    return geoms
+
+
+def _polygon_parts(geoms):
+    """ Keep only the polygon parts of the geometry collections of an array, e.g. the lines
+    along the shared boundary of touching polygons
+    Args:
+        *geoms* : Array of shapely geometries
+    Returns:
+        The same array, with its geometry collections replaced by (multi)polygons
+    """
+    collections = shapely.get_type_id(geoms) == shapely.GeometryType.GEOMETRYCOLLECTION
+    geoms[collections] = shapely.buffer(geoms[collections], 0)
+    return geoms
+
+
+def spatial_overlays(df1, df2, how='intersection', n_jobs=-1):
     """
     Compute overlay intersection of two GeoPandasDataFrames df1 and df2. This
     function is much faster compared to the original geopandas overlay method.
@@ -24,57 +116,61 @@ def spatial_overlays(df1, df2, how='intersection'):
             
         *df2* : The dataframe to intersect or to erase, using the difference function.
         
+        *n_jobs* : Number of threads used for the geometric operations, all cores by default (-1).
+        
     Return:
-        *df1*: an either intersected or (partly) erased geopandas dataframe.
+        *df1*: an either intersected or (partly) erased geopandas dataframe, the input dataframes are left untouched.
     """
 
-    df1 = df1.copy()
-    df2 = df2.copy()
-    df1['geometry'] = df1.geometry.buffer(0)
-    df2['geometry'] = df2.geometry.buffer(0)
+    # Work on (repaired) geometry arrays, the input dataframes are never copied nor modified
+    geoms1 = _make_valid(df1.geometry.values)
+    geoms2 = np.asarray(df2.geometry.values)
+    valid2 = _make_valid(geoms2)
+    if valid2 is geoms2:
+        # Spatial index of df2, cached by geopandas with its geometries so it is only built once across calls
+        tree = df2.sindex
+    else:
+        # Some geometries of df2 were repaired, the index is built on the repaired ones
+        geoms2 = valid2
+        tree = shapely.STRtree(geoms2)
 
 # =============================================================================
 #     """ the part of the function which does the intersection analysis """
 # =============================================================================
     if how=='intersection':
-        # Spatial Index to create intersections
-        spatial_index = df2.sindex
-        df1['bbox'] = df1.geometry.apply(lambda x: x.bounds)
-        df1['histreg']=df1.bbox.apply(lambda x:list(spatial_index.intersection(x)))
-        pairs = df1['histreg'].to_dict()
-        nei = []
-        for i,j in pairs.items():
-            for k in j:
-                nei.append([i,k])
-        
-        pairs = gpd.GeoDataFrame(nei, columns=['idx1','idx2'], crs=df1.crs)
-        pairs = pairs.merge(df1, left_on='idx1', right_index=True)
-        pairs = pairs.merge(df2, left_on='idx2', right_index=True, suffixes=['_1','_2'])
-        pairs['Intersection'] = pairs.apply(lambda x: (x['geometry_1'].intersection(x['geometry_2'])).buffer(0), axis=1)
-        pairs = gpd.GeoDataFrame(pairs, columns=pairs.columns, crs=df1.crs)
-        cols = pairs.columns.tolist()
-        cols.remove('geometry_1')
-        cols.remove('geometry_2')
-        cols.remove('histreg')
-        cols.remove('bbox')
-        cols.remove('Intersection')
-        dfinter = pairs[cols+['Intersection']].copy()
-        dfinter.rename(columns={'Intersection':'geometry'}, inplace=True)
-        dfinter = gpd.GeoDataFrame(dfinter, columns=dfinter.columns, crs=pairs.crs)
-        dfinter = dfinter.loc[dfinter.geometry.is_empty==False]
+        # Spatial Index to create intersections, queried for all geometries at once
+        idx1, idx2 = tree.query(geoms1, predicate='intersects')
+        inter = _in_chunks(shapely.intersection, geoms1[idx1], geoms2[idx2], n_jobs=n_jobs)
+        inter = _polygon_parts(_make_valid(inter))
+        # Drop empty intersections and the shared boundaries of touching polygons
+        keep = shapely.area(inter) > 0
+        idx1, idx2, inter = idx1[keep], idx2[keep], inter[keep]
+        # Assemble the attributes of both dataframes once, only for the kept pairs
+        attr1 = df1.drop(columns=df1.geometry.name)
+        attr2 = df2.drop(columns=df2.geometry.name)
+        common = attr1.columns.intersection(attr2.columns)
+        attr1 = attr1.rename(columns={col: col+'_1' for col in common})
+        attr2 = attr2.rename(columns={col: col+'_2' for col in common})
+        dfinter = pd.concat([pd.DataFrame({'idx1': df1.index[idx1], 'idx2': df2.index[idx2]}),
+                             attr1.take(idx1).reset_index(drop=True),
+                             attr2.take(idx2).reset_index(drop=True)], axis=1)
+        dfinter = gpd.GeoDataFrame(dfinter, geometry=inter, crs=df1.crs)
         return dfinter
 # =============================================================================
 #     """ the part of the function which does the difference/erase analysis """
 # =============================================================================
     elif how=='difference':
-        spatial_index = df2.sindex
-        df1['bbox'] = df1.geometry.apply(lambda x: x.bounds)
-        df1['histreg']=df1.bbox.apply(lambda x:list(spatial_index.intersection(x)))
-        df1['new_g'] = df1.apply(lambda x: reduce(lambda x, y: x.difference(y).buffer(0), [x.geometry]+list(df2.iloc[x.histreg].geometry)) , axis=1)
-        df1.geometry = df1.new_g
-        df1 = df1.loc[df1.geometry.is_empty==False].copy()
-        df1.drop(['bbox', 'histreg', 'new_g'], axis=1, inplace=True)
-        return df1
+        idx1, idx2 = tree.query(geoms1, predicate='intersects')
+        order = np.argsort(idx1, kind='stable')
+        bounds = np.searchsorted(idx1[order], np.arange(len(df1)+1))
+        groups = [idx2[order][i:j] for i, j in zip(bounds[:-1], bounds[1:])]
+        new_g = _in_chunks(lambda g1, groups1: _erase(g1, groups1, geoms2),
+                           geoms1, groups, n_jobs=n_jobs)
+        new_g = _polygon_parts(_make_valid(new_g))
+        keep = ~shapely.is_empty(new_g)
+        dfdiff = gpd.GeoDataFrame(df1.loc[keep, df1.columns.drop(df1.geometry.name)],
+                                  geometry=new_g[keep], crs=df1.crs)
+        return dfdiff
 
 
 def get_country(country,continent_osm,base_path,overwrite=False,RAI=False):  
@@ -89,7 +185,7 @@ def get_country(country,continent_osm,base_path,overwrite=False,RAI=False):
                         
         *base_path* : The base path to location of all files and scripts.
         
-        *overwrite* : This is set on True by default, set on False if you are sure the input files are correct (it will save a lot of computation time).
+        *overwrite* : Not used anymore, the roads are read directly from the .osm.pbf file. Kept for backward compatibility.
         *RAI* : This is set on False by default. set on True if this country extracting is used for the RAI analysis. It will skip the road length calculation (saving computation time).
         
     Returns:
@@ -99,7 +195,6 @@ def get_country(country,continent_osm,base_path,overwrite=False,RAI=False):
 # =============================================================================
 #     """ First set all paths for output dirs"""
 # =============================================================================
-    ctry_out = os.path.join(base_path,'country_data')
     osm_path_out = os.path.join(base_path,'osm_country')
     poly_dir = os.path.join(base_path,'poly_files')
 
@@ -108,43 +203,26 @@ def get_country(country,continent_osm,base_path,overwrite=False,RAI=False):
 #     """ Set the paths for the files we are going to use and write"""
 # =============================================================================
     country_poly = os.path.join(poly_dir,country+'.poly') 
-    country_shp =  os.path.join(ctry_out,country+'.shp') 
     country_pbf = os.path.join(osm_path_out,country+'.osm.pbf') 
     
 # =============================================================================
-#     # extract osm file for the country and write to shapefile
+#     # extract osm file for the country and load the roads
 # =============================================================================
 
     if os.path.exists(country_pbf) is not True:
         clip_osm(continent_osm,country_poly,country_pbf)
         
-    # get shapefile as output
-#    if   (os.path.getsize(country_shp) == 143):
-    if (os.path.exists(country_shp) is not True) or overwrite == True:
-        extract_osm(country_shp,country_pbf)
+    load_country = extract_osm(country_pbf)
 
 # =============================================================================
-#     Load the shapefile, remove road tags which only occur less than 15 times 
+#     Remove road tags which only occur less than 15 times 
 #     and estimate the length of the remaining roads    
 # =============================================================================
-    try:
-        load_country = gpd.read_file(country_shp)
-    except:
-        sleep(30)
-        try:
-            load_country = gpd.read_file(country_shp)
-        except:
-            sleep(60)
-            load_country = gpd.read_file(country_shp)
-
-    uniq = load_country['highway'].value_counts()
-    uniq = list(uniq[uniq > 20].index)
-    uniq.extend(['primary','secondary','trunk','motorway'])
-    uniq = list(set(uniq))
-    load_country = load_country[load_country['highway'].isin(uniq)]
+
+    load_country = remove_rare_roads(load_country,'highway')
     
     if RAI is False:
-        load_country['distance'] = load_country['geometry'].apply(line_length)
+        load_country['distance'] = lines_length(load_country.geometry.values)
         load_country = load_country[load_country['distance'] < 500]        
         
 
@@ -160,6 +238,28 @@ def get_country(country,continent_osm,base_path,overwrite=False,RAI=False):
 
 
 
+def remove_rare_roads(load_country,column,min_count=20):
+    """ 
+    Remove the roads whose tag occurs min_count times or less, except for the main road types.
+    
+    Args:
+        *load_country* : A geodataframe containing all the roads of a country.
+        
+        *column* : The name of the column containing the road tags ('highway' or 'fclass').
+        
+        *min_count* : Tags occurring this many times or less are removed.
+        
+    Returns:
+        *load_country* : The same geodataframe without the roads having a rare tag.
+    """
+    
+    tags = load_country[column].astype('category')
+    codes = tags.cat.codes.values
+    counts = np.bincount(codes[codes >= 0], minlength=len(tags.cat.categories))
+    keep = set(tags.cat.categories[counts > min_count]) | {'primary','secondary','trunk','motorway'}
+    return load_country[tags.isin(keep).values]
+
+
 def clip_osm(continent_osm,country_poly,country_pbf):
     """ Clip the country osm file from the larger continent (or planet) file and save to a new osm.pbf file. 
     This is much faster compared to clipping the osm.pbf file while extracting through ogr2ogr.
@@ -179,51 +279,130 @@ def clip_osm(continent_osm,country_poly,country_pbf):
         A clipped .osm.pbf file.
     """ 
 
-    os.system('osmconvert64 %s -B=%s --complete-ways -o=%s' %(continent_osm,country_poly,country_pbf))
+    subprocess.run(['osmconvert64', continent_osm, '-B='+country_poly, '--complete-ways', '-o='+country_pbf],
+                   check=True)
 
 
-def extract_osm(country_shp,country_pbf):
-    """Extract a shapefile with all the road information from the openstreetmap file.
+def clip_and_extract(continent_osm,country_poly):
+    """ Clip the country from the continent osm file and extract its roads, without writing the clipped
+    osm.pbf file to disk. The output of osmconvert is piped into memory and read from there by GDAL.
+    
+    Use clip_osm and extract_osm instead if the clipped file should be kept for later runs.
     
     Args:
-        *country_shp* : The path string indicating the final output directory and output name of the new shapefile.
+        *continent_osm* : path string to the osm.pbf file of the continent associated with the country.
         
-        *country_pbf* : The path string indicating the directory and name of the .osm.pbf file.
+        *country_poly* : path string to the .poly file, made through the 'create_poly_files' function.
+        
+    Returns:
+        A geodataframe with all the roads of the clipped country, see extract_osm.
+    """ 
+
+    clipped = subprocess.run(['osmconvert64', continent_osm, '-B='+country_poly, '--complete-ways', '--out-pbf'],
+                             check=True, stdout=subprocess.PIPE)
+    return extract_osm(clipped.stdout)
+
+
+def extract_osm(country_pbf):
+    """Extract a geodataframe with all the road information from the openstreetmap file.
+    The file is read directly through GDAL, without writing an intermediate shapefile.
+    
+    Args:
+        *country_pbf* : The path string indicating the directory and name of the .osm.pbf file, or the bytes of its content.
         
     Returns:
-        A shapefile with all the roads of the clipped country. The shapefile will be in *WGS84* (epsg:4326). This is the same coordinate system as Openstreetmap.
+        A geodataframe with all the roads of the clipped country. The geodataframe will be in *WGS84* (epsg:4326). This is the same coordinate system as Openstreetmap.
     """
     
-    os.system('ogr2ogr -overwrite -skipfailures -f "ESRI Shapefile" -progress \
-              -sql "SELECT highway FROM lines WHERE highway IS \
-              NOT NULL" -lco ENCODING=UTF-8 '+country_shp+" " + country_pbf)    
+    return pyogrio.read_dataframe(country_pbf, layer='lines', columns=['highway'],
+                                  where="highway IS NOT NULL", read_geometry=True)
         
 
 
-def line_length(line, ellipsoid='WGS-84'):
-    """Length of a line in meters, given in geographic coordinates.
-    Adapted from https://gis.stackexchange.com/questions/4022/looking-for-a-pythonic-way-to-calculate-the-length-of-a-wkt-linestring#answer-115285
+def _seg_lengths_km(pts):
+    """ Great-circle length of the segments between consecutive vertices
     Args:
-        *line* : A shapely LineString object with WGS-84 coordinates.
-        
-        *ellipsoid* : The string name of an ellipsoid that `geopy` understands (see http://geopy.readthedocs.io/en/latest/#module-geopy.distance).
+        *pts* : Array of shape (N,2) with the coordinates in degrees of the vertices
+    Returns:
+        A numpy array with the N-1 segment lengths in kilometers
+    """
+    lons = np.radians(pts[:,0])
+    lats = np.radians(pts[:,1])
+    a, b = lats[:-1], lats[1:]
+    dlon = lons[1:]-lons[:-1]
+    h = np.sin((b-a)/2)**2 + np.cos(a)*np.cos(b)*np.sin(dlon/2)**2
+    return 2*np.arcsin(np.sqrt(h))*_EARTH_RADIUS_KM
+
+
+def line_length(line):
+    """Length of a line in kilometers, given in geographic coordinates.
+    Args:
+        *line* : A shapely LineString or MultiLineString object with WGS-84 coordinates.
+    Returns:
+        The length of the line in kilometers.
+    """
+    if line.geom_type == 'MultiLineString':
+        return sum(line_length(segment) for segment in line.geoms)
+
+    pts = np.asarray(line.coords, dtype=np.float64)
+    return _seg_lengths_km(pts).sum()
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _haversine_sum(lons, lats, starts, ends):
+    """ Great-circle length of each polyline stored in flat coordinate arrays
+    Args:
+        *lons*, *lats* : Coordinates in degrees of all vertices, polyline after polyline
+        *starts*, *ends* : Index of the first and one past the last vertex of each polyline
     Returns:
-        The length of the line in meters.
+        A numpy array with the length of each polyline in kilometers
     """
-    if line.geometryType() == 'MultiLineString':
-        return sum(line_length(segment) for segment in line)
+    out = np.zeros(len(starts))
+    for i in prange(len(starts)):
+        total = 0.0
+        for j in range(starts[i], ends[i]-1):
+            lat1 = np.radians(lats[j])
+            lat2 = np.radians(lats[j+1])
+            dlat = lat2-lat1
+            dlon = np.radians(lons[j+1]-lons[j])
+            a = np.sin(dlat/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin(dlon/2)**2
+            total += 2*np.arcsin(np.sqrt(a))
+        out[i] = total*_EARTH_RADIUS_KM
+    return out
+
+
+def _haversine_sum_numpy(coords, coord_idx, n):
+    """ Numpy equivalent of _haversine_sum working on the dense (N,2) coordinate array
+    Args:
+        *coords* : Array of shape (N,2) with the coordinates in degrees of all vertices
+        *coord_idx* : Index of the polyline each vertex belongs to
+        *n* : Number of polylines
+    Returns:
+        A numpy array with the length of each polyline in kilometers
+    """
+    dist = _seg_lengths_km(coords)
+    # segments joining the last vertex of a polyline to the first of the next one
+    dist[coord_idx[1:] != coord_idx[:-1]] = 0
+    return np.bincount(coord_idx[1:], weights=dist, minlength=n)
 
-    try:
-        return sum(
-            vincenty(a, b, ellipsoid=ellipsoid).kilometers
-            for a, b in pairwise(line.coords)
-        )
-    except:
-        return sum(
-            vincenty(a, b, ellipsoid=ellipsoid).kilometers
-            for a, b in pairwise(list([t[::-1] for t in list(line.coords)]))
-        )
 
+def lines_length(geoms):
+    """ Great-circle length of an array of (Multi)LineStrings in WGS-84, computed in one pass
+    Args:
+        *geoms* : Array or GeoSeries of shapely LineString or MultiLineString objects
+    Returns:
+        A numpy array with the length of each geometry in kilometers
+    """
+    geoms = np.asarray(geoms)
+    parts, part_idx = shapely.get_parts(geoms, return_index=True)
+    coords, coord_idx = shapely.get_coordinates(parts, return_index=True)
+    if _HAS_NUMBA:
+        starts = np.searchsorted(coord_idx, np.arange(len(parts)), side='left')
+        ends = np.searchsorted(coord_idx, np.arange(len(parts)), side='right')
+        part_lengths = _haversine_sum(coords[:,0], coords[:,1], starts, ends)
+    else:
+        part_lengths = _haversine_sum_numpy(coords, coord_idx, len(parts))
+    return np.bincount(part_idx, weights=part_lengths, minlength=len(geoms))
 
 
 def map_roads(load_country):
@@ -303,7 +482,11 @@ def map_roads(load_country):
 "unknown":"other"
 }
     
-    load_country['roads'] = load_country['fclass'].map(lambda x: (dict_map[x])) 
+    # Look up the distinct road types once and gather the result with their integer codes.
+    # Unknown road types are classified as 'other', the extra last entry is used for missing values (code -1)
+    fclass = load_country['fclass'].astype('category')
+    mapping_arr = np.array([dict_map.get(c, 'other') for c in fclass.cat.categories]+['other'], dtype=object)
+    load_country['roads'] = mapping_arr.take(fclass.cat.codes.values)
     
     return load_country
 
@@ -324,72 +507,106 @@ def explode(gdf):
                                  and two new columns: level_0 and level_1
         
     """
-    gs = gdf.explode()
-    gdf2 = gs.reset_index().rename(columns={0: 'geometry'})
-    gdf_out = gdf2.merge(gdf.drop('geometry', axis=1), left_on='level_0', right_index=True)
-    gdf_out = gdf_out.set_index(['level_0', 'level_1']).set_geometry('geometry')
-    gdf_out.crs = gdf.crs
+    gdf_out = gdf.explode(index_parts=True)
+    gdf_out.index = gdf_out.index.set_names(['level_0', 'level_1'])
     return gdf_out
 
-def extract_osm_rail(country_shp,country_pbf):
-    """Extract a shapefile with all the road information from the openstreetmap file.
+def extract_osm_rail(country_pbf):
+    """Extract a geodataframe with all the railway information from the openstreetmap file.
+    The file is read directly through GDAL, without writing an intermediate shapefile.
     
     Args:
-        *country_shp* : The path string indicating the final output directory and output name of the new shapefile.
-        
         *country_pbf* : The path string indicating the directory and name of the .osm.pbf file.
         
     Returns:
-        A shapefile with all the roads of the clipped country. The shapefile will be in *WGS84* (epsg:4326). This is the same coordinate system as Openstreetmap.
+        A geodataframe with all the railways of the clipped country. The geodataframe will be in *WGS84* (epsg:4326). This is the same coordinate system as Openstreetmap.
     """
     
-    os.system('ogr2ogr -overwrite -skipfailures -f "ESRI Shapefile" -progress \
-              -sql "SELECT railway FROM lines WHERE railway IS \
-              NOT NULL" -lco ENCODING=UTF-8 '+country_shp+" " + country_pbf)    
+    return pyogrio.read_dataframe(country_pbf, layer='lines', columns=['railway'],
+                                  where="railway IS NOT NULL", read_geometry=True)
 
 
 #%% Method to Create buffer
+def _scale_lon(geoms,lon0,factor):
+    """ Scale the longitudes of each geometry around lon0 by factor
+    Args:
+        *geoms* : Array of shapely geometries
+        *lon0* : Array with the reference longitude of each geometry
+        *factor* : Array with the scale factor of each geometry
+    Returns:
+        An array of scaled shapely geometries
+    """
+
+    coords, idx = shapely.get_coordinates(geoms, return_index=True)
+    coords[:,0] = lon0[idx] + (coords[:,0]-lon0[idx])*factor[idx]
+    return shapely.set_coordinates(geoms.copy(), coords)
+
+
 def Create_Buffer(gdf,epsg1,size):
     """ Create buffer of size "size" from GeoDataFrame in the projection of epsg1
+    Buffers smaller than SMALL_BUFFER meters around features in geographic coordinates spanning less than
+    SMALL_BUFFER_LAT_SPAN degrees of latitude are computed directly in degrees, without reprojection
     Args:
         *gdf* : GeoDataFrame
         *epsg1* : projection number
-        *size* : size of buffer
+        *size* : size of buffer in meters
     Returns:
         A GeoDataFrame with new buffered geometries
     """
 
-    gdf1 = gdf.copy()
-    gdf1 = gdf1.to_crs(epsg=epsg1)
-    gdf1['geometry'] = gdf1.buffer(size)
-    gdf1 = gdf1.to_crs(epsg=4326)
-    return gdf1
-
-
-def geom_within_country(x,geo_country):
-    """ Given a geometry, return the geometry of its intersection with geo_country
+    buffered = np.empty(len(gdf), dtype=object)
+    small = np.zeros(len(gdf), dtype=bool)
+    if size < SMALL_BUFFER and gdf.crs is not None and gdf.crs.is_geographic:
+        geoms = np.asarray(gdf.geometry.to_crs(epsg=4326).values)
+        # A single cos(lat) per feature is only accurate for features with a small latitude span
+        bounds = shapely.bounds(geoms)
+        small = (bounds[:,3]-bounds[:,1]) < SMALL_BUFFER_LAT_SPAN
+        # Stretch the longitudes by cos(lat) of each feature so that one degree is about
+        # the same distance along both axes, buffer in degrees and stretch back
+        centroids = shapely.centroid(geoms[small])
+        lon0, lat0 = shapely.get_x(centroids), shapely.get_y(centroids)
+        phi = np.radians(lat0)
+        cos_lat = np.cos(phi)
+        # Length in meters of one degree of latitude at the latitude of each feature
+        m_per_deg_lat = 111132.92 - 559.82*np.cos(2*phi) + 1.175*np.cos(4*phi)
+        small_buffered = shapely.buffer(_scale_lon(geoms[small], lon0, cos_lat), size/m_per_deg_lat)
+        buffered[small] = _scale_lon(small_buffered, lon0, 1/cos_lat)
+    if not small.all():
+        buffered[~small] = np.asarray(gdf.geometry[~small].to_crs(epsg=epsg1).buffer(size).to_crs(epsg=4326).values)
+
+    # Only the attributes are copied, the original geometries are not carried over
+    return gpd.GeoDataFrame(gdf.drop(columns=gdf.geometry.name), geometry=buffered, crs=4326)
+
+
+def apply_within_country(gdf,geo_country):
+    """ Clip the geometries of a GeoDataFrame which are not within the country to geo_country.
+    To be used as: gdf['geometry'] = apply_within_country(gdf,geo_country)
     Args:
-        *x* : Geopandas row
+        *gdf* : GeoDataFrame with a boolean 'within_country' column
         *geo_country* : Shapely geometry
     Returns:
-        A shapely geometry of the intersection
+        A numpy array of shapely geometries
     """
 
-    if not x['within_country']:
-        return x['geometry'].intersection(geo_country)
-    else:
-        return x['geometry']
+    geoms = np.asarray(gdf.geometry.values)
+    todo = ~gdf['within_country'].values.astype(bool)
+    # Geometries whose envelope lies fully inside the country are kept as they are,
+    # only the ones crossing the boundary go through the (expensive) intersection
+    shapely.prepare(geo_country)
+    todo[todo] = ~shapely.contains_properly(geo_country, shapely.envelope(geoms[todo]))
+    return shapely.intersection(geoms, geo_country, out=geoms.copy(), where=todo)
 
     
-def delete_roads_urb(x,geo_urban):
-    """ Given a geometry, returns the geometry of its difference with geo_country
+def apply_delete_roads_urb(gdf,geo_urban):
+    """ Remove geo_urban from the geometries of a GeoDataFrame which intersect urban areas.
+    To be used as: gdf['geometry'] = apply_delete_roads_urb(gdf,geo_urban)
     Args:
-        *x* : Geopandas row
+        *gdf* : GeoDataFrame with a boolean 'inter_urb' column
         *geo_urban* : Shapely geometry
     Returns:
-        A shapely geometry of the difference
+        A numpy array of shapely geometries
     """
-    if x['inter_urb']:
-        return x['geometry'].difference(geo_urban)
-    else:
-        return x['geometry']
\ No newline at end of file
+
+    geoms = np.asarray(gdf.geometry.values)
+    return shapely.difference(geoms, geo_urban, out=geoms.copy(),
+                              where=gdf['inter_urb'].values.astype(bool))